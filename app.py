@@ -2,7 +2,7 @@
 """
 Flask Web Application for Attendance Management System
 """
-from flask import Flask, render_template, request, jsonify, send_file
+from flask import Flask, render_template, request, jsonify, send_file, Response
 import cv2
 import numpy as np
 import os
@@ -11,6 +11,14 @@ import pandas as pd
 import datetime
 import time
 import base64
+import io
+import math
+import tempfile
+import threading
+import re
+import unicodedata
+from urllib.parse import quote
+from collections import OrderedDict
 from werkzeug.utils import secure_filename
 import json
 
@@ -18,6 +26,11 @@ app = Flask(__name__)
 app.config['UPLOAD_FOLDER'] = 'uploads'
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
 
+# Capture quality thresholds for registration images, overridable via environment
+app.config['MIN_FACE_SIZE'] = int(os.environ.get('MIN_FACE_SIZE', 80))                  # minimum face width/height in pixels
+app.config['MIN_BLUR_VARIANCE'] = float(os.environ.get('MIN_BLUR_VARIANCE', 60.0))      # minimum Laplacian variance (lower = blurrier)
+app.config['DUPLICATE_THRESHOLD'] = float(os.environ.get('DUPLICATE_THRESHOLD', 4.0))   # mean abs difference below which a face is a near-duplicate
+
 # Create necessary directories
 os.makedirs('uploads', exist_ok=True)
 os.makedirs('TrainingImage', exist_ok=True)
@@ -33,11 +46,15 @@ trainimagelabel_path = "TrainingImageLabel/Trainner.yml"
 trainimage_path = "TrainingImage"
 studentdetail_path = "StudentDetails/studentdetails.csv"
 attendance_path = "Attendance"
+duplicate_history = 5        # number of recent faces kept per student for comparison
+duplicate_students = 20      # number of students whose recent faces are cached
 
 class FaceRecognitionSystem:
     def __init__(self):
         self.recognizer = None
         self.detector = cv2.CascadeClassifier(haarcasecade_path)
+        self.recent_faces = OrderedDict()
+        self.recent_faces_lock = threading.Lock()
         self.load_recognizer()
     
     def load_recognizer(self):
@@ -68,6 +85,58 @@ class FaceRecognitionSystem:
         except:
             return None, 0
     
+    def check_face_quality(self, face_image, key):
+        """Check a cropped face for size, sharpness and duplication.
+
+        An accepted face is reserved in the duplicate cache straight away so
+        concurrent captures of the same frame are rejected. Returns
+        (True, thumbnail) if the face should be saved, otherwise
+        (False, reason). Pass the thumbnail to release_face if the image
+        could not be written.
+        """
+        min_face_size = app.config['MIN_FACE_SIZE']
+        h, w = face_image.shape[:2]
+        if w < min_face_size or h < min_face_size:
+            return False, f'Face too small ({w}x{h}), move closer to the camera'
+        
+        blur = cv2.Laplacian(face_image, cv2.CV_64F).var()
+        if blur < app.config['MIN_BLUR_VARIANCE']:
+            return False, f'Image too blurry (sharpness {blur:.1f}), hold still'
+        
+        # Compare a small normalized thumbnail against recently accepted faces
+        thumb = cv2.resize(face_image, (32, 32), interpolation=cv2.INTER_AREA)
+        thumb = cv2.equalizeHist(thumb).astype(np.float32)
+        with self.recent_faces_lock:
+            for previous in self.recent_faces.get(key, []):
+                if np.mean(np.abs(thumb - previous)) < app.config['DUPLICATE_THRESHOLD']:
+                    return False, 'Near-duplicate of a previous image, change pose slightly'
+            
+            # Keep only the most recent faces of the most recent students
+            recent = self.recent_faces.setdefault(key, [])
+            self.recent_faces.move_to_end(key)
+            recent.append(thumb)
+            if len(recent) > duplicate_history:
+                recent.pop(0)
+            while len(self.recent_faces) > duplicate_students:
+                self.recent_faces.popitem(last=False)
+        
+        return True, thumb
+    
+    def release_face(self, key, thumb):
+        """Drop a thumbnail reserved by check_face_quality whose image was not saved"""
+        with self.recent_faces_lock:
+            recent = self.recent_faces.get(key)
+            if recent is None:
+                return
+            self.recent_faces[key] = [t for t in recent if t is not thumb]
+            if not self.recent_faces[key]:
+                del self.recent_faces[key]
+    
+    def forget_faces(self, key):
+        """Clear the duplicate cache for a student"""
+        with self.recent_faces_lock:
+            self.recent_faces.pop(key, None)
+    
     def train_model(self):
         """Train the face recognition model"""
         try:
@@ -120,6 +189,108 @@ class FaceRecognitionSystem:
             
         return faces, ids
 
+def list_session_files(subject, start_date=None, end_date=None):
+    """List (label, path) for a subject's session files, oldest first.
+
+    Sessions are filtered on the date encoded in the filename
+    ({subject}_{date}_{time}.csv), so files outside the range are never opened.
+    """
+    subject_path = os.path.join(attendance_path, subject)
+    prefix = f"{subject}_"
+    sessions = []
+    for filename in os.listdir(subject_path):
+        if not filename.endswith('.csv') or not filename.startswith(prefix):
+            continue
+        label = filename[len(prefix):-len('.csv')]
+        date = label.split('_')[0]
+        if start_date and date < start_date:
+            continue
+        if end_date and date > end_date:
+            continue
+        sessions.append((label, os.path.join(subject_path, filename)))
+    sessions.sort()
+    return sessions
+
+def collect_attendance(sessions):
+    """Read session files one at a time into {enrollment: [name, attended session indices]}
+
+    Only one session file is open at a time, but the result holds every
+    student's attended sessions for the whole range, so memory grows with
+    students x sessions. With one file per session this is needed before
+    any complete row can be produced.
+    """
+    students = {}
+    for index, (label, filepath) in enumerate(sessions):
+        with open(filepath, newline='') as csvfile:
+            reader = csv.reader(csvfile)
+            next(reader, None)
+            for row in reader:
+                if len(row) < 3:
+                    continue
+                entry = students.setdefault(row[0], [row[1], set()])
+                if row[2].strip() not in ('', '0'):
+                    entry[1].add(index)
+    return students
+
+def attendance_percentage(attended, total):
+    """Percentage of sessions attended, rounded like the attendance table"""
+    return round(len(attended) / total * 100, 2) if total else 0.0
+
+def iter_attendance_rows(sessions, students, enrollments=None):
+    """Yield one attendance row per student, matching get_attendance's columns"""
+    total = len(sessions)
+    if enrollments is None:
+        enrollments = students.keys()
+    for enrollment in enrollments:
+        name, attended = students[enrollment]
+        marks = [1 if i in attended else 0 for i in range(total)]
+        yield [enrollment, name] + marks + [attendance_percentage(attended, total)]
+
+def parse_date_range(args):
+    """Read optional start/end (YYYY-MM-DD) query parameters, raising ValueError if malformed"""
+    dates = []
+    for key in ('start', 'end'):
+        value = args.get(key, '').strip()
+        if value:
+            try:
+                # Normalize to zero-padded form so it compares correctly with filename dates
+                value = datetime.datetime.strptime(value, "%Y-%m-%d").strftime("%Y-%m-%d")
+            except ValueError:
+                raise ValueError('Dates must be in YYYY-MM-DD format')
+        dates.append(value or None)
+    start_date, end_date = dates
+    if start_date and end_date and start_date > end_date:
+        raise ValueError('Start date must be on or before end date')
+    return start_date, end_date
+
+def parse_number(args, key, cast, default=None):
+    """Read an optional numeric query parameter, raising ValueError if it cannot be parsed"""
+    value = args.get(key, '').strip()
+    if not value:
+        return default
+    try:
+        return cast(value)
+    except ValueError:
+        raise ValueError(f'Invalid value for {key}: {value}')
+
+def parse_percentage(args, key):
+    """Read an optional percentage query parameter, raising ValueError unless it is a finite value in 0-100"""
+    value = parse_number(args, key, float)
+    if value is not None and not (math.isfinite(value) and 0 <= value <= 100):
+        raise ValueError(f'{key} must be between 0 and 100')
+    return value
+
+def set_attachment_header(response, download_name):
+    """Set Content-Disposition the same way send_file does, with an RFC 5987 fallback for non-ASCII names"""
+    try:
+        download_name.encode('ascii')
+        options = {'filename': download_name}
+    except UnicodeEncodeError:
+        simple = unicodedata.normalize('NFKD', download_name).encode('ascii', 'ignore').decode('ascii')
+        options = {'filename': simple, 'filename*': "UTF-8''" + quote(download_name, safe="!#$&+^`|~")}
+    response.headers.set('Content-Disposition', 'attachment', **options)
+    return response
+
 # Initialize the face recognition system
 face_system = FaceRecognitionSystem()
 
@@ -162,6 +333,7 @@ def capture_images():
             return jsonify({'success': False, 'message': 'Student data already exists'})
         
         os.makedirs(path, exist_ok=True)
+        face_system.forget_faces(directory)
         
         # Save student details to CSV
         with open(studentdetail_path, "a+", newline='') as csvFile:
@@ -208,13 +380,25 @@ def save_image():
         if face_img.size == 0:
             return jsonify({'success': False, 'message': 'Invalid face crop'})
         
-        # Save the face image
+        # Reject blurry, small or near-duplicate faces before writing
         directory = f"{enrollment}_{name}"
+        accepted, result = face_system.check_face_quality(face_img, directory)
+        if not accepted:
+            return jsonify({'success': False, 'rejected': True, 'message': result})
+        
+        # Save the face image
         path = os.path.join(trainimage_path, directory)
         filename = f"{name}_{enrollment}_{image_number}.jpg"
         filepath = os.path.join(path, filename)
         
-        cv2.imwrite(filepath, face_img)
+        written = False
+        try:
+            written = cv2.imwrite(filepath, face_img)
+        finally:
+            if not written:
+                face_system.release_face(directory, result)
+        if not written:
+            return jsonify({'success': False, 'message': 'Failed to write image'})
         
         return jsonify({'success': True, 'message': f'Image {image_number} saved successfully'})
         
@@ -336,45 +520,204 @@ def mark_attendance():
 
 @app.route('/api/get_attendance/<subject>')
 def get_attendance(subject):
-    """API endpoint to get attendance records for a subject"""
+    """API endpoint to get attendance records for a subject
+    
+    Optional query parameters: start/end (YYYY-MM-DD), enrollment
+    (comma-separated), min_percentage/max_percentage, sort (enrollment, name
+    or percentage, prefix with '-' for descending), limit and cursor.
+    """
     try:
+        try:
+            start_date, end_date = parse_date_range(request.args)
+            min_percentage = parse_percentage(request.args, 'min_percentage')
+            max_percentage = parse_percentage(request.args, 'max_percentage')
+            limit = parse_number(request.args, 'limit', int)
+            cursor = parse_number(request.args, 'cursor', int, 0)
+        except ValueError as e:
+            return jsonify({'success': False, 'message': str(e)})
+        
+        if min_percentage is not None and max_percentage is not None and min_percentage > max_percentage:
+            return jsonify({'success': False, 'message': 'min_percentage must be less than or equal to max_percentage'})
+        
+        sort = request.args.get('sort', 'enrollment').strip()
+        descending = sort.startswith('-')
+        sort_key = sort.lstrip('-')
+        if sort_key not in ('enrollment', 'name', 'percentage'):
+            return jsonify({'success': False, 'message': 'Sort must be enrollment, name or percentage'})
+        
+        if (limit is not None and limit < 1) or cursor < 0:
+            return jsonify({'success': False, 'message': 'Limit must be positive and cursor non-negative'})
+        
         subject_path = os.path.join(attendance_path, subject)
         if not os.path.exists(subject_path):
             return jsonify({'success': False, 'message': 'Subject not found'})
         
-        # Get all CSV files for the subject
-        csv_files = [f for f in os.listdir(subject_path) if f.endswith('.csv')]
+        # Only session files inside the date range are opened
+        sessions = list_session_files(subject, start_date, end_date)
         
-        if not csv_files:
+        if not sessions:
             return jsonify({'success': False, 'message': 'No attendance records found'})
         
-        # Read and merge all CSV files
-        dfs = []
-        for csv_file in csv_files:
-            df = pd.read_csv(os.path.join(subject_path, csv_file))
-            dfs.append(df)
+        students = collect_attendance(sessions)
+        total_sessions = len(sessions)
+        
+        # Filter and sort on enrollment/name/percentage before building any rows
+        enrollment_filter = request.args.get('enrollment', '').strip()
+        if enrollment_filter:
+            wanted = {value.strip() for value in enrollment_filter.split(',') if value.strip()}
+            enrollments = [e for e in students if e in wanted]
+        else:
+            enrollments = list(students)
+        
+        percentages = {e: attendance_percentage(students[e][1], total_sessions) for e in enrollments}
+        if min_percentage is not None:
+            enrollments = [e for e in enrollments if percentages[e] >= min_percentage]
+        if max_percentage is not None:
+            enrollments = [e for e in enrollments if percentages[e] <= max_percentage]
+        
+        if sort_key == 'percentage':
+            enrollments.sort(key=lambda e: percentages[e], reverse=descending)
+        elif sort_key == 'name':
+            enrollments.sort(key=lambda e: students[e][0].lower(), reverse=descending)
+        else:
+            enrollments.sort(key=lambda e: (not e.isdigit(), int(e) if e.isdigit() else 0, e),
+                             reverse=descending)
+        
+        # Summary statistics cover the whole filtered set, not just the returned page
+        total = len(enrollments)
+        today = datetime.date.today().strftime("%Y-%m-%d")
+        today_sessions = {i for i, (label, _) in enumerate(sessions) if label.split('_')[0] == today}
+        stats = {
+            'total_students': total,
+            'present_today': sum(1 for e in enrollments if students[e][1] & today_sessions),
+            'average_attendance': round(sum(percentages[e] for e in enrollments) / total, 2) if total else 0.0
+        }
+        
+        end = total if limit is None else cursor + limit
+        page = enrollments[cursor:end]
+        next_cursor = end if end < total else None
+        
+        columns = ['Enrollment', 'Name'] + [label for label, _ in sessions] + ['Attendance_Percentage']
+        records = [dict(zip(columns, row)) for row in iter_attendance_rows(sessions, students, page)]
         
-        if not dfs:
-            return jsonify({'success': False, 'message': 'No data found'})
+        return jsonify({
+            'success': True,
+            'records': records,
+            'total': total,
+            'stats': stats,
+            'next_cursor': next_cursor
+        })
         
-        # Merge all dataframes
-        merged_df = dfs[0]
-        for df in dfs[1:]:
-            merged_df = merged_df.merge(df, how='outer', on=['Enrollment', 'Name'])
+    except Exception as e:
+        return jsonify({'success': False, 'message': f'Error: {str(e)}'})
+
+def write_xlsx_export(output, subject, header, sessions, students):
+    """Write attendance rows to an XLSX file object"""
+    from openpyxl import Workbook
+    
+    # Write-only mode appends rows to the file instead of keeping cells in memory
+    workbook = Workbook(write_only=True)
+    # Excel forbids : \ / ? * [ ] in sheet titles and limits them to 31 characters
+    sheet_title = re.sub(r'[:\\/?*\[\]]', '_', subject)[:31] or 'Attendance'
+    sheet = workbook.create_sheet(title=sheet_title)
+    sheet.append(header)
+    for row in iter_attendance_rows(sessions, students):
+        sheet.append(row)
+    workbook.save(output)
+
+def write_parquet_export(output, sessions, students):
+    """Write attendance rows to a Parquet file object in row groups"""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    
+    schema = pa.schema(
+        [('Enrollment', pa.string()), ('Name', pa.string())]
+        + [(label, pa.int8()) for label, _ in sessions]
+        + [('Attendance_Percentage', pa.float64())]
+    )
+    # Only one batch of rows is converted to Arrow at a time
+    batch_size = 1000
+    with pq.ParquetWriter(output, schema) as writer:
+        def write_batch(batch):
+            arrays = [pa.array(list(column), type=field.type)
+                      for column, field in zip(zip(*batch), schema)]
+            writer.write_table(pa.Table.from_arrays(arrays, schema=schema))
+        
+        batch = []
+        for row in iter_attendance_rows(sessions, students):
+            batch.append(row)
+            if len(batch) >= batch_size:
+                write_batch(batch)
+                batch = []
+        if batch:
+            write_batch(batch)
+
+@app.route('/api/export_attendance/<subject>')
+def export_attendance(subject):
+    """API endpoint to export attendance for a subject as CSV, XLSX or Parquet
+
+    Attendance for the date range is collected first (see collect_attendance);
+    CSV rows are then streamed, while XLSX and Parquet are written to a
+    temporary file and sent once complete.
+    """
+    try:
+        export_format = request.args.get('format', 'csv').lower()
         
-        # Fill NaN values with 0
-        merged_df.fillna(0, inplace=True)
+        if export_format not in ('csv', 'xlsx', 'parquet'):
+            return jsonify({'success': False, 'message': 'Format must be csv, xlsx or parquet'})
         
-        # Calculate attendance percentage
-        date_columns = [col for col in merged_df.columns if col not in ['Enrollment', 'Name']]
-        if date_columns:
-            merged_df['Attendance_Percentage'] = merged_df[date_columns].mean(axis=1) * 100
-            merged_df['Attendance_Percentage'] = merged_df['Attendance_Percentage'].round(2)
+        try:
+            start_date, end_date = parse_date_range(request.args)
+        except ValueError as e:
+            return jsonify({'success': False, 'message': str(e)})
         
-        # Convert to list of dictionaries
-        records = merged_df.to_dict('records')
+        subject_path = os.path.join(attendance_path, subject)
+        if not os.path.exists(subject_path):
+            return jsonify({'success': False, 'message': 'Subject not found'})
         
-        return jsonify({'success': True, 'records': records})
+        sessions = list_session_files(subject, start_date, end_date)
+        if not sessions:
+            return jsonify({'success': False, 'message': 'No attendance records found'})
+        
+        students = collect_attendance(sessions)
+        header = ['Enrollment', 'Name'] + [label for label, _ in sessions] + ['Attendance_Percentage']
+        download_name = f"{subject}_attendance.{export_format}"
+        
+        if export_format == 'csv':
+            def generate():
+                buffer = io.StringIO()
+                writer = csv.writer(buffer)
+                writer.writerow(header)
+                for row in iter_attendance_rows(sessions, students):
+                    writer.writerow(row)
+                    yield buffer.getvalue()
+                    buffer.seek(0)
+                    buffer.truncate(0)
+                yield buffer.getvalue()
+            
+            return set_attachment_header(Response(generate(), mimetype='text/csv'), download_name)
+        
+        # XLSX and Parquet need a complete file before sending, so build it in a
+        # temporary file on disk; it is deleted when send_file closes it
+        output = tempfile.TemporaryFile()
+        try:
+            if export_format == 'xlsx':
+                write_xlsx_export(output, subject, header, sessions, students)
+                mimetype = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+            else:
+                write_parquet_export(output, sessions, students)
+                mimetype = 'application/vnd.apache.parquet'
+            output.seek(0)
+        except ImportError:
+            output.close()
+            if export_format == 'xlsx':
+                return jsonify({'success': False, 'message': 'XLSX export requires openpyxl'})
+            return jsonify({'success': False, 'message': 'Parquet export requires pyarrow'})
+        except Exception:
+            output.close()
+            raise
+        
+        return send_file(output, mimetype=mimetype, as_attachment=True, download_name=download_name)
         
     except Exception as e:
         return jsonify({'success': False, 'message': f'Error: {str(e)}'})